@@ -2,8 +2,36 @@
 import imaplib
 import os
 import sys
+import time
+import argparse
 
-def get_gmail_folders():
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'imap_count')
+CACHE_TTL = 24 * 60 * 60
+
+def cache_path(user):
+    return os.path.join(CACHE_DIR, f"folders_{user}.txt")
+
+def read_cached_folders(user):
+    # Serve from the cache while it is younger than CACHE_TTL
+    path = cache_path(user)
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().splitlines()
+    except OSError:
+        return None
+
+def write_cached_folders(user, folders):
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(cache_path(user), os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write("\n".join(folders) + "\n")
+    except OSError as e:
+        print(f"Warning: could not write folder cache: {e}")
+
+def get_gmail_folders(refresh=False):
     # Retrieve credentials from environment variables
     user = os.getenv('GMAIL_ACCT')
     password = os.getenv('GMAIL_PASS')
@@ -12,21 +40,32 @@ def get_gmail_folders():
         print("Error: GMAIL_ACCT or GMAIL_PASS environment variables not set.")
         sys.exit(1)
 
+    if not refresh:
+        cached = read_cached_folders(user)
+        if cached is not None:
+            print(f"Folders for {user}:")
+            for folder in cached:
+                print(folder)
+            return
+
     try:
         # Connect to Gmail's IMAP server
         mail = imaplib.IMAP4_SSL('imap.gmail.com')
         mail.login(user, password)
-        
+
         # Retrieve the list of folders/labels
         # list() returns a tuple: (status, [list of folders])
         status, folders = mail.list()
 
         if status == 'OK':
             print(f"Folders for {user}:")
+            decoded = []
             for folder in folders:
-                # The folder string contains flags and the delimiter; 
+                # The folder string contains flags and the delimiter;
                 # we decode and print the full line.
-                print(folder.decode('utf-8'))
+                decoded.append(folder.decode('utf-8'))
+                print(decoded[-1])
+            write_cached_folders(user, decoded)
         else:
             print("Failed to retrieve folders.")
 
@@ -38,4 +77,8 @@ def get_gmail_folders():
         print(f"An unexpected error occurred: {e}")
 
 if __name__ == "__main__":
-    get_gmail_folders()
+    parser = argparse.ArgumentParser(description="List the folders/labels of a Gmail account.")
+    parser.add_argument("--refresh", action="store_true", help="Ignore the cached folder list and query the server")
+    args = parser.parse_args()
+
+    get_gmail_folders(args.refresh)
@@ -0,0 +1,101 @@
+"""Connection, UID-set and sender-list helpers shared by imap_count.py and imap_delete.py."""
+import imaplib
+import logging
+import re
+import socket
+import ssl
+import threading
+
+READ_BUFFER_SIZE = 1 << 20
+EMAIL_REGEX = re.compile(r'^[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}$')
+
+logger = logging.getLogger(__name__)
+
+_tls_lock = threading.Lock()
+_tls_sessions = {}
+_ssl_context = None
+
+def tune_socket(sock):
+    # Small command/response exchanges stall behind Nagle + delayed ACK otherwise
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        logger.debug("Could not set TCP_NODELAY: %s", e)
+
+    # Keepalives surface silently dropped NAT/firewall sessions on long runs
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 20), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError as e:
+        logger.debug("Could not enable TCP keepalive: %s", e)
+
+def shared_ssl_context():
+    # TLS sessions can only be resumed through the context that created them
+    global _ssl_context
+    with _tls_lock:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context()
+            _ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        return _ssl_context
+
+def remember_tls_session(mail):
+    # TLS 1.3 tickets arrive after the handshake, so call this once logged in
+    with _tls_lock:
+        _tls_sessions[mail.host] = mail.sock.session
+
+class BufferedIMAP4_SSL(imaplib.IMAP4_SSL):
+    def _create_socket(self, timeout):
+        # Offer the last session for this host so later connections resume instead of full handshakes
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        with _tls_lock:
+            session = _tls_sessions.get(self.host)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=session)
+
+    def open(self, host='', port=imaplib.IMAP4_SSL_PORT, timeout=None):
+        super().open(host, port, timeout)
+        # A large buffer lets readline() pull big SEARCH/FETCH lines in few recv calls
+        self.file.close()
+        self.file = self.sock.makefile('rb', buffering=READ_BUFFER_SIZE)
+
+def compress_uids(uid_list):
+    if not uid_list:
+        return b""
+    ranges = []
+    start = end = uid_list[0]
+
+    for n in uid_list[1:]:
+        if n == end + 1:
+            end = n
+        else:
+            ranges.append(f"{start}:{end}" if start != end else str(start))
+            start = end = n
+
+    ranges.append(f"{start}:{end}" if start != end else str(start))
+    return ",".join(ranges).encode()
+
+def validate_sender(sender: str) -> bool:
+    return bool(EMAIL_REGEX.fullmatch(sender))
+
+def read_senders(path):
+    # Addresses are interpolated into SEARCH strings, so anything that is not a
+    # plain address is dropped
+    senders = []
+    with open(path, "r") as f:
+        for line in f:
+            sender = line.strip()
+            if not sender:
+                continue
+            if validate_sender(sender):
+                senders.append(sender)
+            else:
+                logger.warning("Skipping invalid sender address: %r", sender)
+    return senders
+
+def unique_senders(senders):
+    # Addresses that differ only in case are one sender; keep the first spelling
+    unique = {}
+    for sender in senders:
+        unique.setdefault(sender.casefold(), sender)
+    return list(unique.values())
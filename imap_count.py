@@ -6,27 +6,43 @@ import time
 import socket
 import threading
 import concurrent.futures
+import itertools
 import signal
 import logging
+import logging.handlers
 import argparse
-from email.utils import parseaddr
+import re
+import sqlite3
 from collections import Counter
 from tqdm import tqdm
+from imap_common import (BufferedIMAP4_SSL, compress_uids, read_senders, remember_tls_session, shared_ssl_context,
+                         tune_socket, unique_senders)
 
 imaplib._MAXLINE = 100000000
 CONNECTION_TIMEOUT = 60
 MAX_WORKERS = 5
 CHUNK_SIZE = 1000
+PIPELINE_DEPTH = 8
+IN_FLIGHT_PER_WORKER = 2
+IDLE_NOOP_INTERVAL = 25 * 60
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'imap_count', 'headers.sqlite')
 
-# Configure logging
-logging.basicConfig(
-    filename='imap_processor.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'
-)
+FETCH_TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+')
+QUOTED_ESCAPE_RE = re.compile(rb'\\(.)')
+
+LOG_FILE = 'imap_processor.log'
+
+def _configure_logging():
+    # No-op if the root logger is already set up; the file opens on first record
+    logging.basicConfig(
+        handlers=[logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=1_000_000, backupCount=3, delay=True)],
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'
+    )
 
 shutdown_flag = threading.Event()
 active_connections = []
+idle_connections = []
 connection_lock = threading.Lock()
 
 def signal_handler(sig, frame):
@@ -39,7 +55,7 @@ def signal_handler(sig, frame):
             try:
                 conn.logout()
             except Exception as e:
-                logging.debug(f"Error during shutdown logout: {e}")
+                logging.debug("Error during shutdown logout: %s", e)
     sys.exit(0)
 
 class ResilientIMAP:
@@ -52,6 +68,7 @@ class ResilientIMAP:
         self.mail = None
         self.current_folder = None
         self.readonly = False
+        self.last_activity = 0.0
         self._connect()
 
     def _connect(self):
@@ -62,14 +79,17 @@ class ResilientIMAP:
                 pass
         
         try:
-            self.mail = imaplib.IMAP4_SSL(self.host, timeout=self.timeout)
+            self.mail = BufferedIMAP4_SSL(self.host, ssl_context=shared_ssl_context(), timeout=self.timeout)
+            tune_socket(self.mail.sock)
             self.mail.login(self.user, self.password)
+            remember_tls_session(self.mail)
+            self.last_activity = time.monotonic()
             logging.info("Successfully established IMAP connection.")
             
             if self.current_folder:
                 self.mail.select(self.current_folder, readonly=self.readonly)
         except Exception as e:
-            logging.error(f"Connection failed: {e}")
+            logging.error("Connection failed: %s", e)
             raise ConnectionError(f"Failed to connect to {self.host}") from e
 
     def select(self, folder, readonly=False):
@@ -77,30 +97,69 @@ class ResilientIMAP:
         self.readonly = readonly
         return self.mail.select(folder, readonly=readonly)
 
-    def _retry_operation(self, op_name, *args, **kwargs):
+    def _ensure_alive(self):
+        # Providers drop idle sessions after ~30 minutes; probe before reusing one
+        if time.monotonic() - self.last_activity < IDLE_NOOP_INTERVAL:
+            return
+        try:
+            self.mail.noop()
+        except Exception as e:
+            logging.info("Idle connection went stale (%s). Reconnecting.", e)
+            self._connect()
+        self.last_activity = time.monotonic()
+
+    def _retry_operation(self, operation, *args, **kwargs):
+        # operation must look up self.mail on each call, since a retry reconnects
+        op_name = operation.__name__.lstrip('_')
         last_exception = None
         for attempt in range(self.retries):
             if shutdown_flag.is_set():
                 return 'ABORT', []
                 
             try:
-                func = getattr(self.mail, op_name)
-                return func(*args, **kwargs)
+                self._ensure_alive()
+                result = operation(*args, **kwargs)
+                self.last_activity = time.monotonic()
+                return result
             except (imaplib.IMAP4.abort, socket.error, EOFError) as e:
                 last_exception = e
-                logging.warning(f"Operation '{op_name}' failed ({e}). Retrying {attempt + 1}/{self.retries}...")
+                logging.warning("Operation '%s' failed (%s). Retrying %d/%d...", op_name, e, attempt + 1, self.retries)
                 if attempt < self.retries - 1:
                     time.sleep(2)
                     self._connect()
         
-        logging.error(f"Operation '{op_name}' exhausted retries. Last error: {last_exception}")
+        logging.error("Operation '%s' exhausted retries. Last error: %s", op_name, last_exception)
         raise last_exception
 
-    def search(self, *args, **kwargs):
-        return self._retry_operation('search', *args, **kwargs)
+    def uid(self, *args, **kwargs):
+        return self._retry_operation(self._uid, *args, **kwargs)
+
+    def _uid(self, *args, **kwargs):
+        return self.mail.uid(*args, **kwargs)
 
-    def fetch(self, *args, **kwargs):
-        return self._retry_operation('fetch', *args, **kwargs)
+    def fetch_pipelined(self, *args, **kwargs):
+        return self._retry_operation(self._fetch_pipelined, *args, **kwargs)
+
+    def _fetch_pipelined(self, id_sets, message_parts):
+        # Put every FETCH on the wire before waiting for the first tagged reply,
+        # so the batches share one round-trip instead of paying one each.
+        self.mail.untagged_responses.pop('FETCH', None)
+        tags = [self.mail._command('UID', 'FETCH', ids, message_parts) for ids in id_sets]
+
+        # Every tag is read even after a failure, so one rejected set neither
+        # leaves replies on the wire nor hides the rows the other sets returned.
+        status = 'OK'
+        for ids, tag in zip(id_sets, tags):
+            try:
+                typ, data = self.mail._command_complete('UID', tag)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                typ, data = 'BAD', [e]
+            if typ != 'OK':
+                logging.warning("FETCH of UIDs %s returned %s: %s", ids.decode(), typ, data)
+                status = typ
+        return status, self.mail.untagged_responses.pop('FETCH', [])
 
     def logout(self):
         try:
@@ -111,13 +170,21 @@ class ResilientIMAP:
             self.mail.logout()
             logging.info("IMAP connection closed and logged out.")
         except Exception as e:
-            logging.debug(f"Logout exception: {e}")
+            logging.debug("Logout exception: %s", e)
 
 
 thread_local = threading.local()
 
 def get_thread_connection(host, user, password, folder):
     if not hasattr(thread_local, "mail"):
+        with connection_lock:
+            conn = idle_connections.pop() if idle_connections else None
+
+        if conn is not None:
+            logging.info("Reusing idle IMAP connection for this thread.")
+            thread_local.mail = conn
+            return conn
+
         logging.info("Initializing new thread-local IMAP connection.")
         conn = ResilientIMAP(host, user, password, timeout=CONNECTION_TIMEOUT)
         conn.select(folder, readonly=True)
@@ -128,83 +195,224 @@ def get_thread_connection(host, user, password, folder):
             
     return thread_local.mail
 
-def fetch_chunk(chunk, host, user, password, folder):
+def parse_fetch_response(msg_data):
+    # Flatten imaplib's mix of bytes lines and (prefix, literal) tuples into
+    # nested lists, returning one attribute dict per message in the response.
+    stack = [[]]
+    for part in msg_data:
+        if isinstance(part, tuple):
+            text, literal = part
+        else:
+            text, literal = part, None
+        if not text:
+            continue
+
+        for match in FETCH_TOKEN_RE.finditer(text):
+            token = match.group()
+            if token == b'(':
+                stack.append([])
+            elif token == b')':
+                if len(stack) > 1:
+                    closed = stack.pop()
+                    stack[-1].append(closed)
+            elif token.startswith(b'"'):
+                stack[-1].append(QUOTED_ESCAPE_RE.sub(rb'\1', token[1:-1]))
+            elif token.startswith(b'{'):
+                stack[-1].append(literal)
+            elif token.upper() == b'NIL':
+                stack[-1].append(None)
+            else:
+                stack[-1].append(token)
+
+    messages = []
+    top = stack[0]
+    for attributes in top[1::2]:
+        if isinstance(attributes, list):
+            keys = [k.upper() if isinstance(k, bytes) else k for k in attributes[::2]]
+            messages.append(dict(zip(keys, attributes[1::2])))
+    return messages
+
+def envelope_sender(envelope):
+    # ENVELOPE is (date subject from sender reply-to to cc bcc in-reply-to message-id);
+    # each address in "from" is (name adl mailbox host).
+    if not isinstance(envelope, list) or len(envelope) < 3 or not envelope[2]:
+        return None
+    address = envelope[2][0]
+    if not isinstance(address, list) or len(address) < 4:
+        return None
+    mailbox, host = address[2], address[3]
+    if not mailbox or not host:
+        return None
+    # Domains repeat heavily across senders, so share one string per domain
+    local = mailbox.decode('utf-8', errors='ignore').casefold()
+    domain = sys.intern(host.decode('utf-8', errors='ignore').casefold())
+    return local, domain
+
+def fetch_chunks(chunks, host, user, password, folder):
     if shutdown_flag.is_set():
         return []
         
     mail = get_thread_connection(host, user, password, folder)
-    fetch_ids = b','.join(chunk)
-    senders = []
+    id_sets = [compress_uids([int(uid) for uid in chunk]) for chunk in chunks]
+    rows = []
     
     try:
-        status, msg_data = mail.fetch(fetch_ids, '(BODY[HEADER.FIELDS (FROM)])')
+        # Failed sets are logged per tag; rows from the sets that succeeded are kept
+        _, msg_data = mail.fetch_pipelined(id_sets, '(UID ENVELOPE)')
         
-        if status == 'OK':
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    try:
-                        header_str = response_part[1].decode('utf-8', errors='ignore')
-                        if header_str.lower().startswith('from:'):
-                            name, email_address = parseaddr(header_str[5:])
-                            if email_address:
-                                senders.append(email_address.lower())
-                    except Exception as e:
-                        logging.debug(f"Failed to parse header: {e}")
-                        continue
-        else:
-            logging.warning(f"Fetch command returned status: {status}")
+        try:
+            for attributes in parse_fetch_response(msg_data):
+                uid = attributes.get(b'UID')
+                if uid is None:
+                    continue
+                # Unparseable senders are still cached so they are not refetched
+                local, domain = envelope_sender(attributes.get(b'ENVELOPE')) or (None, None)
+                rows.append((int(uid), local, domain))
+        except Exception as e:
+            logging.debug("Failed to parse envelope: %s", e)
             
     except Exception as e:
-        logging.error(f"Exception during chunk fetch: {e}")
+        logging.error("Exception during chunk fetch: %s", e)
         
-    return senders
+    return rows
 
 
-def list_top_senders(username, password, imap_server, folder="INBOX"):
+# ---------- Header Cache ----------
+
+def open_header_cache(path):
+    if path != ':memory:':
+        # The cache holds sender addresses, so keep it private to the user;
+        # SQLite gives its journal files the database file's mode.
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS headers ("
+        "account TEXT, folder TEXT, uidvalidity INTEGER, uid INTEGER, local TEXT, domain TEXT, "
+        "PRIMARY KEY (account, folder, uidvalidity, uid))"
+    )
+    return db
+
+def sync_header_cache(db, scope, email_ids):
+    # Drop rows from an older UIDVALIDITY or for messages that have since gone,
+    # and return only the UIDs that still need their headers fetched.
+    account, folder, uidvalidity = scope
+    db.execute("DELETE FROM headers WHERE account = ? AND folder = ? AND uidvalidity != ?", scope)
+
+    cached = {uid for (uid,) in db.execute(
+        "SELECT uid FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ?", scope)}
+    current = {int(uid) for uid in email_ids}
+    stale = cached - current
+    if stale:
+        db.executemany(
+            "DELETE FROM headers WHERE account = ? AND folder = ? AND uidvalidity = ? AND uid = ?",
+            ((account, folder, uidvalidity, uid) for uid in stale)
+        )
+    db.commit()
+    return [uid for uid in email_ids if int(uid) not in cached]
+
+def store_headers(db, scope, rows):
+    db.executemany(
+        "INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?)",
+        (scope + row for row in rows)
+    )
+    db.commit()
+
+def count_cached_senders(db, scope):
+    cursor = db.execute(
+        "SELECT local, domain, COUNT(*) FROM headers "
+        "WHERE account = ? AND folder = ? AND uidvalidity = ? AND local IS NOT NULL "
+        "GROUP BY local, domain", scope
+    )
+    return Counter({(local, sys.intern(domain)): count for local, domain, count in cursor})
+
+
+def iter_batches(email_ids, depth):
+    # Slice lazily so only the batches currently in flight are materialized
+    step = CHUNK_SIZE * depth
+    for i in range(0, len(email_ids), step):
+        window = email_ids[i:i + step]
+        yield [window[j:j + CHUNK_SIZE] for j in range(0, len(window), CHUNK_SIZE)]
+
+
+def list_top_senders(username, password, imap_server, folder="INBOX", top=None, threshold=2, cache_path=CACHE_FILE,
+                     workers=MAX_WORKERS, pipeline_depth=PIPELINE_DEPTH):
+    main_conn = cache = None
     try:
         logging.info("Initializing main connection to retrieve message IDs.")
         main_conn = ResilientIMAP(imap_server, username, password, timeout=CONNECTION_TIMEOUT)
         status, _ = main_conn.select(folder, readonly=True)
         if status != 'OK':
-            logging.error(f"Failed to select folder: {folder}")
+            logging.error("Failed to select folder: %s", folder)
             print(f"Error: Could not select folder '{folder}'. Check logs.")
+            main_conn.logout()
             return
 
-        status, messages = main_conn.search(None, 'ALL')
+        status, messages = main_conn.uid('SEARCH', None, 'ALL')
         if status != 'OK':
             logging.error("Failed to retrieve messages via search command.")
             print("Error: Could not retrieve messages. Check logs.")
+            main_conn.logout()
             return
 
         email_ids = messages[0].split()
-        main_conn.logout()
+        _, validity = main_conn.mail.response('UIDVALIDITY')
+        uidvalidity = int(validity[0]) if validity and validity[0] else 0
+
+        cache = open_header_cache(cache_path)
+        scope = (f"{username}@{imap_server}", folder, uidvalidity)
+        cached_total = len(email_ids)
+        email_ids = sync_header_cache(cache, scope, email_ids)
+        cached_total -= len(email_ids)
+
+        # Already logged in with the folder selected: hand it to the first worker
+        with connection_lock:
+            active_connections.append(main_conn)
+            idle_connections.append(main_conn)
     except Exception as e:
-        logging.critical(f"Fatal initialization error: {e}")
+        logging.critical("Fatal initialization error: %s", e)
         print(f"Fatal error during initialization: {e}. Check logs.")
+        if cache is not None:
+            cache.close()
+        if main_conn is not None:
+            main_conn.logout()
         return
 
-    logging.info(f"Starting to process {len(email_ids)} messages across {MAX_WORKERS} threads.")
-    print(f"Processing {len(email_ids)} messages (Press Ctrl+C to abort)...")
+    logging.info("Starting to process %d messages across %d threads (%d cached).", len(email_ids), workers, cached_total)
+    print(f"Processing {len(email_ids)} messages, {cached_total} cached (Press Ctrl+C to abort)...")
+
+    chunk_count = -(-len(email_ids) // CHUNK_SIZE)
+    # Pipeline several chunks per task, but never so many that workers sit idle
+    depth = max(1, min(pipeline_depth, -(-chunk_count // workers)))
+    batches = iter_batches(email_ids, depth)
 
-    chunks = [email_ids[i:i + CHUNK_SIZE] for i in range(0, len(email_ids), CHUNK_SIZE)]
-    all_senders = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(batch):
+            future = executor.submit(fetch_chunks, batch, imap_server, username, password, folder)
+            pending[future] = batch
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(fetch_chunk, chunk, imap_server, username, password, folder): chunk for chunk in chunks}
+        # Keep the queue just non-empty: a few batches per worker, refilled as each completes
+        pending = {}
+        for batch in itertools.islice(batches, IN_FLIGHT_PER_WORKER * workers):
+            submit(batch)
         
-        with tqdm(total=len(email_ids)) as pbar:
-            for future in concurrent.futures.as_completed(futures):
-                if shutdown_flag.is_set():
-                    break
+        with tqdm(total=len(email_ids), mininterval=1.0, disable=not sys.stderr.isatty()) as pbar:
+            while pending and not shutdown_flag.is_set():
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    batch = pending.pop(future)
+                    try:
+                        store_headers(cache, scope, future.result())
+                    except Exception as e:
+                        logging.error("Chunk execution failed completely: %s", e)
                     
-                chunk = futures[future]
-                try:
-                    chunk_senders = future.result()
-                    all_senders.extend(chunk_senders)
-                except Exception as e:
-                    logging.error(f"Chunk execution failed completely: {e}")
-                
-                pbar.update(len(chunk))
+                    pbar.update(sum(len(chunk) for chunk in batch))
+
+                    next_batch = next(batches, None)
+                    if next_batch is not None and not shutdown_flag.is_set():
+                        submit(next_batch)
 
     if not shutdown_flag.is_set():
         logging.info("Processing complete. Cleaning up connections.")
@@ -212,21 +420,64 @@ def list_top_senders(username, password, imap_server, folder="INBOX"):
             for conn in active_connections:
                 conn.logout()
 
-    sender_counts = Counter(all_senders)
-    filtered_sorted_senders = sorted(
-        [(sender, count) for sender, count in sender_counts.items() if count > 1],
-        key=lambda item: item[1], 
-        reverse=True
-    )
+    sender_counts = count_cached_senders(cache, scope)
+    cache.close()
+    print_sender_statistics(sender_counts, top, threshold)
+
+
+def count_known_senders(username, password, imap_server, folder, candidates, top=None, threshold=2):
+    # With a known candidate list the server can do the counting: one SEARCH
+    # per sender and no header FETCH at all.
+    try:
+        conn = ResilientIMAP(imap_server, username, password, timeout=CONNECTION_TIMEOUT)
+        status, _ = conn.select(folder, readonly=True)
+        if status != 'OK':
+            logging.error("Failed to select folder: %s", folder)
+            print(f"Error: Could not select folder '{folder}'. Check logs.")
+            return
+    except Exception as e:
+        logging.critical("Fatal initialization error: %s", e)
+        print(f"Fatal error during initialization: {e}. Check logs.")
+        return
+
+    is_gmail = "gmail" in imap_server.lower()
+    sender_counts = Counter()
+
+    for address in tqdm(candidates, unit="sender", mininterval=1.0, disable=not sys.stderr.isatty()):
+        if shutdown_flag.is_set():
+            break
+        try:
+            if is_gmail:
+                status, data = conn.uid('SEARCH', 'X-GM-RAW', f'"from:{address}"')
+            else:
+                status, data = conn.uid('SEARCH', None, f'(FROM "{address}")')
+        except Exception as e:
+            logging.error("Search for %s failed: %s", address, e)
+            continue
+
+        if status == 'OK' and data and data[0]:
+            local, _, domain = address.casefold().partition('@')
+            sender_counts[(local, sys.intern(domain))] = len(data[0].split())
+
+    conn.logout()
+    print_sender_statistics(sender_counts, top, threshold)
+
+
+def print_sender_statistics(sender_counts, top, threshold):
+    # most_common(N) is a partial heap selection; without N it is a single sort
+    filtered_sorted_senders = [
+        (sender, count) for sender, count in sender_counts.most_common(top) if count >= threshold
+    ]
 
     print("\n--- Sender Statistics ---")
     if not filtered_sorted_senders:
-        print("No senders with more than 1 message found.")
+        print(f"No senders with at least {threshold} messages found.")
     else:
-        for sender, count in filtered_sorted_senders:
-            print(f"{count:4d} | {sender}")
+        for (local, domain), count in filtered_sorted_senders:
+            print(f"{count:4d} | {local}@{domain}")
 
 if __name__ == "__main__":
+    _configure_logging()
     signal.signal(signal.SIGINT, signal_handler)
     
     parser = argparse.ArgumentParser(description="Count top senders in a specific IMAP folder.")
@@ -234,6 +485,13 @@ if __name__ == "__main__":
     parser.add_argument("-u", "--user", default=os.getenv('GMAIL_ACCT'), help="IMAP username (defaults to GMAIL_ACCT env var)")
     parser.add_argument("-p", "--password", default=os.getenv('GMAIL_PASS'), help="IMAP password (defaults to GMAIL_PASS env var)")
     parser.add_argument("-s", "--server", default="imap.gmail.com", help="IMAP server (defaults to imap.gmail.com)")
+    parser.add_argument("--top", type=int, default=None, help="Only show the N most frequent senders")
+    parser.add_argument("--threshold", type=int, default=2, help="Minimum messages for a sender to be listed (defaults to 2)")
+    parser.add_argument("--cache", default=CACHE_FILE, help=f"Header cache database (defaults to {CACHE_FILE})")
+    parser.add_argument("--no-cache", action="store_true", help="Keep headers in memory only for this run")
+    parser.add_argument("-t", "--threads", type=int, default=MAX_WORKERS, help=f"Number of concurrent IMAP connections (defaults to {MAX_WORKERS})")
+    parser.add_argument("--pipeline", type=int, default=PIPELINE_DEPTH, help=f"FETCH commands in flight per connection (defaults to {PIPELINE_DEPTH})")
+    parser.add_argument("--file", help="File of known sender addresses to count server-side instead of fetching headers")
     
     args = parser.parse_args()
 
@@ -241,7 +499,12 @@ if __name__ == "__main__":
         print("Error: Username and password must be provided via command-line arguments or environment variables.")
         sys.exit(1)
 
-    logging.info(f"Script started. Server: {args.server}, Target folder: {args.folder}")
-    list_top_senders(args.user, args.password, args.server, args.folder)
+    logging.info("Script started. Server: %s, Target folder: %s", args.server, args.folder)
+    if args.file:
+        count_known_senders(args.user, args.password, args.server, args.folder, unique_senders(read_senders(args.file)), args.top, args.threshold)
+    else:
+        cache_path = ':memory:' if args.no_cache else args.cache
+        list_top_senders(args.user, args.password, args.server, args.folder, args.top, args.threshold, cache_path,
+                         max(1, args.threads), max(1, args.pipeline))
     logging.info("Script execution finished.")
 
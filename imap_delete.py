@@ -5,40 +5,62 @@ import re
 import ssl
 import sys
 import logging
+import logging.handlers
 import time
+import random
 import argparse
+import hashlib
 import socket
 import threading
 import concurrent.futures
 import signal
+import zlib
+from array import array
 from datetime import datetime, timedelta
 from tqdm import tqdm
+from imap_common import (BufferedIMAP4_SSL, compress_uids, read_senders, remember_tls_session, shared_ssl_context,
+                         tune_socket, unique_senders, validate_sender)
 
 imaplib._MAXLINE = 10000000
+# RFC 4978; imaplib refuses commands it does not know about
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
 
 LOG_FILE = "imap_errors.log"
+SEARCH_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "imap_delete")
+# Room for the tag, command name and mailbox argument around a UID set
+COMMAND_OVERHEAD = 128
+MIN_CMD_BYTES = 512
 
 # ---------- Logging & Signals ----------
 
-def secure_file_handler(path: str):
-    flags = os.O_APPEND | os.O_CREAT | os.O_WRONLY
-    fd = os.open(path, flags, 0o600)
-    os.close(fd)
+class SecureRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Create the log (and every rotated successor) as 0600 rather than umask default
+    def _open(self):
+        flags = os.O_APPEND | os.O_CREAT | os.O_WRONLY
+        fd = os.open(self.baseFilename, flags, 0o600)
+        return open(fd, self.mode, encoding=self.encoding, errors=self.errors)
 
-    handler = logging.FileHandler(path)
+def secure_file_handler(path: str):
+    # delay=True: the file is only opened once something is actually logged to it
+    handler = SecureRotatingFileHandler(path, maxBytes=1_000_000, backupCount=3, delay=True)
     handler.setLevel(logging.WARNING)
     formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(threadName)s - %(message)s")
     handler.setFormatter(formatter)
     return handler
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-logger.addHandler(secure_file_handler(LOG_FILE))
-logger.addHandler(logging.StreamHandler(sys.stdout))
+
+def _configure_logging():
+    if logger.handlers:
+        return
+    logger.setLevel(logging.INFO)
+    logger.addHandler(secure_file_handler(LOG_FILE))
+    logger.addHandler(logging.StreamHandler(sys.stdout))
 
 shutdown_flag = threading.Event()
 active_connections = []
 connection_lock = threading.Lock()
+flagged_lock = threading.Lock()
 thread_local = threading.local()
 
 def signal_handler(sig, frame):
@@ -56,22 +78,75 @@ def signal_handler(sig, frame):
 
 # ---------- IMAP Helpers ----------
 
-EMAIL_REGEX = r'^[a-zA-Z0-9._%+\-]+@[a-zA-Z0-9.\-]+\.[a-zA-Z]{2,}$'
-
-def validate_sender(sender: str) -> bool:
-    return bool(re.fullmatch(EMAIL_REGEX, sender))
-
+class DeflateIMAP4_SSL(BufferedIMAP4_SSL):
+    """IMAP4_SSL that can switch the stream to COMPRESS=DEFLATE after login."""
+
+    _compressor = None
+    _decompressor = None
+
+    def enable_compression(self):
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self._inbuf = bytearray()
+        return True
+
+    def send(self, data):
+        if self._compressor:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        super().send(data)
+
+    def _fill(self):
+        data = self.file.read1(65536)
+        if not data:
+            raise self.abort('socket error: EOF')
+        self._inbuf += self._decompressor.decompress(data)
+
+    def read(self, size):
+        if not self._decompressor:
+            return super().read(size)
+        while len(self._inbuf) < size:
+            self._fill()
+        data = bytes(self._inbuf[:size])
+        del self._inbuf[:size]
+        return data
+
+    def readline(self):
+        if not self._decompressor:
+            return super().readline()
+        while (end := self._inbuf.find(b'\n')) == -1:
+            if len(self._inbuf) > imaplib._MAXLINE:
+                raise self.error("got more than %d bytes" % imaplib._MAXLINE)
+            self._fill()
+        line = bytes(self._inbuf[:end + 1])
+        del self._inbuf[:end + 1]
+        return line
+
+ESEARCH_COUNT_RE = re.compile(rb'\bCOUNT (\d+)')
 def get_imap_date_before(days: int) -> str:
     target_date = datetime.now() - timedelta(days=days)
     return target_date.strftime("%d-%b-%Y")
 
-def connect_and_select(server, user, password, mailbox, timeout):
-    ssl_context = ssl.create_default_context()
-    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-
-    mail = imaplib.IMAP4_SSL(server, ssl_context=ssl_context, timeout=timeout)
+def connect_and_select(server, user, password, mailbox, timeout, compress=True):
+    mail = DeflateIMAP4_SSL(server, ssl_context=shared_ssl_context(), timeout=timeout)
+    tune_socket(mail.sock)
     mail.login(user, password)
 
+    remember_tls_session(mail)
+
+    # Servers often advertise extensions such as MOVE and COMPRESS only once authenticated
+    status, caps = mail.capability()
+    if status == "OK" and caps and caps[-1]:
+        mail.capabilities = tuple(str(caps[-1], "ascii", "ignore").upper().split())
+
+    if compress and "COMPRESS=DEFLATE" in mail.capabilities:
+        try:
+            mail.enable_compression()
+        except imaplib.IMAP4.error as e:
+            logger.warning("COMPRESS=DEFLATE rejected, continuing uncompressed: %s", e)
+
     status, _ = mail.select(f'"{mailbox}"')
     if status != "OK":
         raise RuntimeError(f"Cannot select mailbox '{mailbox}'.")
@@ -79,10 +154,10 @@ def connect_and_select(server, user, password, mailbox, timeout):
     mail.sock.settimeout(timeout)
     return mail
 
-def get_thread_connection(server, user, password, folder, timeout):
+def get_thread_connection(server, user, password, folder, timeout, compress=True):
     if not hasattr(thread_local, "mail"):
         logger.info("Initializing new thread-local IMAP connection.")
-        conn = connect_and_select(server, user, password, folder, timeout)
+        conn = connect_and_select(server, user, password, folder, timeout, compress)
         thread_local.mail = conn
         with connection_lock:
             active_connections.append(conn)
@@ -100,32 +175,79 @@ def find_trash_folder(mail):
 
     raise RuntimeError("Trash folder not found.")
 
-def compress_uids(uid_list):
-    if not uid_list:
-        return b""
-    ints = [int(u) for u in uid_list]
-    ranges = []
-    start = end = ints[0]
-
-    for n in ints[1:]:
-        if n == end + 1:
-            end = n
+def take_uid_batch(uids, start, max_count, max_bytes):
+    # Grow the batch from uids[start] while its range-compressed form still
+    # fits in max_bytes; returns the end index and the encoded set.
+    limit = min(len(uids), start + max_count)
+    run_start = prev = uids[start]
+    length = len(str(run_start))
+    end = start + 1
+
+    while end < limit:
+        n = uids[end]
+        if n == prev + 1:
+            # "a" or "a:prev" becomes "a:n"
+            tail = len(str(prev)) + 1 if prev != run_start else 0
+            new_length = length - tail + 1 + len(str(n))
+            new_run_start = run_start
         else:
-            ranges.append(f"{start}:{end}" if start != end else str(start))
-            start = end = n
-
-    ranges.append(f"{start}:{end}" if start != end else str(start))
-    return ",".join(ranges).encode()
-
-def exponential_backoff(attempt, base_delay):
-    return base_delay * (2 ** attempt)
+            new_length = length + 1 + len(str(n))
+            new_run_start = n
+        if new_length > max_bytes:
+            break
+        length, prev, run_start = new_length, n, new_run_start
+        end += 1
+
+    return end, compress_uids(uids[start:end])
+
+def run_pipelined(mail, commands):
+    # Write every tagged UID command before reading any reply, so a window of
+    # batches costs one round-trip instead of one per batch.
+    tags = [mail._command("UID", *command) for command in commands]
+    results = []
+    for tag in tags:
+        # Read every tag even after a BAD so no reply is left for the next window
+        try:
+            results.append(mail._command_complete("UID", tag))
+        except mail.abort:
+            raise
+        except mail.error as e:
+            results.append(("BAD", [str(e).encode()]))
+    for name in ("FETCH", "EXPUNGE"):
+        mail.untagged_responses.pop(name, None)
+    return results
+
+def send_batches(mail, name, batches, *args):
+    # One pipelined command per (start, end, uid_set) batch; returns the
+    # batches the server did not confirm, plus its error responses.
+    results = run_pipelined(mail, [(name, uid_set) + args for _, _, uid_set in batches])
+    failed = [batch for batch, (status, _) in zip(batches, results) if status != "OK"]
+    errors = [response for status, response in results if status != "OK"]
+    return failed, errors
+
+def rebatch(uids, batches, max_count, max_bytes):
+    out = []
+    for start, end, _ in batches:
+        j = start
+        while j < end:
+            k, uid_set = take_uid_batch(uids, j, min(max_count, end - j), max_bytes)
+            out.append((j, k, uid_set))
+            j = k
+    return out
+
+def exponential_backoff(attempt, base_delay, max_delay=None, jitter=0.0):
+    delay = base_delay * (2 ** attempt)
+    if max_delay is not None:
+        delay = min(max_delay, delay)
+    # Jitter keeps parallel workers from retrying in lockstep
+    return delay * (1 + random.uniform(-jitter, jitter))
 
 def wait_with_progress(delay_seconds: float, desc: str = "Waiting"):
     steps = int(delay_seconds)
     remainder = delay_seconds - steps
     
     if steps > 0:
-        for _ in tqdm(range(steps), desc=desc, leave=False, unit="s"):
+        for _ in tqdm(range(steps), desc=desc, leave=False, unit="s", disable=not sys.stderr.isatty()):
             if shutdown_flag.is_set(): return
             time.sleep(1)
             
@@ -134,11 +256,7 @@ def wait_with_progress(delay_seconds: float, desc: str = "Waiting"):
 
 # ---------- Search Builders ----------
 
-def build_standard_search(args):
-    if args.time is not None:
-        cutoff_date = get_imap_date_before(args.time)
-        return f'(SENTBEFORE {cutoff_date})'
-
+def collect_senders(args):
     senders = []
     if args.sender:
         if not validate_sender(args.sender):
@@ -146,11 +264,17 @@ def build_standard_search(args):
         senders.append(args.sender)
 
     if args.file:
-        with open(args.file, "r") as f:
-            for line in f:
-                s = line.strip()
-                if s and validate_sender(s):
-                    senders.append(s)
+        senders.extend(read_senders(args.file))
+
+    # Duplicates only deepen the OR tree the server has to evaluate
+    return unique_senders(senders)
+
+def build_standard_search(args):
+    if args.time is not None:
+        cutoff_date = get_imap_date_before(args.time)
+        return f'(SENTBEFORE {cutoff_date})'
+
+    senders = collect_senders(args)
 
     if not senders:
         sys.exit("Provide sender, --file, or --time.")
@@ -168,18 +292,7 @@ def build_gmail_raw_query(args):
     if args.time is not None:
         parts.append(f"older_than:{args.time}d")
 
-    senders = []
-    if args.sender:
-        if not validate_sender(args.sender):
-            sys.exit("Invalid sender format.")
-        senders.append(args.sender)
-
-    if args.file:
-        with open(args.file, "r") as f:
-            for line in f:
-                s = line.strip()
-                if s and validate_sender(s):
-                    senders.append(s)
+    senders = collect_senders(args)
 
     if senders:
         sender_query = " OR ".join([f"from:{s}" for s in senders])
@@ -190,105 +303,239 @@ def build_gmail_raw_query(args):
 
     return " ".join(parts)
 
+def parse_uids(raw):
+    # One machine word per UID instead of a bytes object per UID; the
+    # transient split() list is dropped as soon as the array is built.
+    return array("L", map(int, raw.split()))
+
 def run_standard_search(mail, query):
     status, data = mail.uid("search", None, query)
     if status != "OK" or not data or not data[0]:
-        return []
-    return data[0].split()
+        return array("L")
+    return parse_uids(data[0])
 
 def run_gmail_search(mail, raw_query):
     status, data = mail.uid("search", "X-GM-RAW", f'"{raw_query}"')
     if status != "OK" or not data or not data[0]:
-        return []
-    return data[0].split()
+        return array("L")
+    return parse_uids(data[0])
+
+def move_saved_search(mail, criteria, trash_folder):
+    # SEARCHRES (RFC 5182): the server keeps the result as "$", so the UIDs
+    # never cross the wire and the whole move is two commands.
+    typ, data = mail._simple_command("UID", "SEARCH", "RETURN", "(SAVE COUNT)", *criteria)
+    if typ != "OK":
+        return None
+    _, esearch = mail._untagged_response(typ, data, "ESEARCH")
+
+    count = 0
+    for line in esearch:
+        match = ESEARCH_COUNT_RE.search(line or b"")
+        if match:
+            count = int(match.group(1))
+
+    if count:
+        status, response = mail.uid("MOVE", "$", f'"{trash_folder}"')
+        if status != "OK":
+            raise RuntimeError(f"MOVE failed: {response}")
+    return count
+
+def search_cache_path(args, server, query, uidvalidity):
+    key = "\0".join([args.user, server, args.folder, query, uidvalidity])
+    return os.path.join(SEARCH_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest() + ".bin")
+
+def load_cached_uids(path):
+    try:
+        with open(path, "rb") as f:
+            uids = array("L")
+            uids.frombytes(f.read())
+    except (OSError, ValueError):
+        return None
+    # A search that matched nothing is never cached, so an empty file is not a resume point
+    return uids or None
+
+def save_cached_uids(path, uids):
+    # Kept only until the run completes, so an interrupted run can resume without re-searching
+    # Written to a temp file and renamed into place, so a failed or killed write
+    # never leaves a truncated list that would resume as a partial run
+    tmp_path = path + ".tmp"
+    try:
+        os.makedirs(SEARCH_CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(tmp_path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600)
+        with open(fd, "wb") as f:
+            f.write(uids.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write search cache: %s", e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+def expunge_all(mail):
+    try:
+        status, response = mail.expunge()
+    except imaplib.IMAP4.error as e:
+        status, response = "BAD", [str(e)]
+    if status != "OK":
+        logger.error("EXPUNGE failed, moved messages remain flagged \\Deleted: %s", response)
+        return False
+    return True
+
+def expunge_flagged(mail, ordered, args):
+    # UID EXPUNGE (RFC 4315) only touches what we flagged, not every \Deleted message
+    budget = max(1, args.max_cmd_bytes - COMMAND_OVERHEAD)
+    refused = False
+    i = 0
+    while i < len(ordered):
+        start = i
+        i, uid_set = take_uid_batch(ordered, i, args.chunk_size, budget)
+        try:
+            status, response = mail.uid("EXPUNGE", uid_set)
+        except imaplib.IMAP4.error as e:
+            status, response = "BAD", [str(e)]
+        # One untagged EXPUNGE per removed message would otherwise pile up
+        mail.untagged_responses.pop("EXPUNGE", None)
+        if status != "OK":
+            logger.warning("UID EXPUNGE of %d messages failed: %s", i - start, response)
+            refused = True
+
+    if refused:
+        # Unlike UID EXPUNGE this also removes anything else already flagged \Deleted
+        logger.warning("Falling back to a plain EXPUNGE for the refused batches.")
+        return expunge_all(mail)
+    return True
 
 # ---------- Worker Thread ----------
 
-def process_chunk(chunk_uids, trash_folder, supports_move, args, server):
+def process_chunk(chunk_uids, trash_folder, move_mode, args, server, flagged):
     if shutdown_flag.is_set():
         return 0
 
     processed = 0
     current_chunk_size = args.chunk_size
+    current_cmd_bytes = args.max_cmd_bytes
     i = 0
     
-    mail = get_thread_connection(server, args.user, args.password, args.folder, args.timeout)
+    mail = get_thread_connection(server, args.user, args.password, args.folder, args.timeout, not args.no_compress)
     quoted_trash = f'"{trash_folder}"'
 
     while i < len(chunk_uids):
         if shutdown_flag.is_set():
             break
 
-        sub_chunk = chunk_uids[i:i + current_chunk_size]
-        uid_str = compress_uids(sub_chunk)
+        budget = max(1, current_cmd_bytes - COMMAND_OVERHEAD - len(quoted_trash))
+        batches = []
+        window_end = i
+        while window_end < len(chunk_uids) and len(batches) < args.pipeline:
+            end, uid_set = take_uid_batch(chunk_uids, window_end, current_chunk_size, budget)
+            batches.append((window_end, end, uid_set))
+            window_end = end
 
-        for attempt in range(args.retries):
+        # Only batches whose trash step is still unconfirmed are resent; a
+        # repeated COPY would leave duplicates in Trash.
+        pending = list(batches)
+        attempt = 0
+
+        while attempt < args.retries:
             if shutdown_flag.is_set():
                 break
 
             try:
-                if supports_move:
-                    status, response = mail.uid("MOVE", uid_str, quoted_trash)
-                    if status != "OK":
-                        raise RuntimeError(f"MOVE failed: {response}")
+                if move_mode == "MOVE":
+                    name = "MOVE"
+                    pending, errors = send_batches(mail, "MOVE", pending, quoted_trash)
+                elif move_mode == "LABEL":
+                    # Gmail moves a message to Trash as soon as it carries the \Trash label
+                    name = "STORE"
+                    pending, errors = send_batches(mail, "STORE", pending, "+X-GM-LABELS", r"(\Trash)")
                 else:
-                    status, response = mail.uid("COPY", uid_str, quoted_trash)
-                    if status != "OK":
-                        raise RuntimeError(f"COPY failed: {response}")
-
-                    status, response = mail.uid("STORE", uid_str, "+FLAGS", r"\Deleted")
-                    if status != "OK":
-                        raise RuntimeError(f"STORE failed: {response}")
-
-                i += len(sub_chunk)
-                processed += len(sub_chunk)
+                    name = "COPY"
+                    pending, errors = send_batches(mail, "COPY", pending, quoted_trash)
+                    if not errors:
+                        # Every COPY must succeed before anything is flagged \Deleted
+                        name = "STORE"
+                        _, errors = send_batches(mail, "STORE", batches, "+FLAGS", r"\Deleted")
+
+                if errors:
+                    raise RuntimeError(f"{name} failed: {errors[0]}")
+
+                if move_mode == "COPY":
+                    with flagged_lock:
+                        flagged.extend(chunk_uids[i:window_end])
+
+                processed += window_end - i
+                i = window_end
                 
                 if args.chunk_delay > 0:
                     time.sleep(args.chunk_delay)
                 break
 
             except (imaplib.IMAP4.abort, ssl.SSLError, socket.error):
-                delay = exponential_backoff(attempt, args.delay)
-                logger.warning(f"Connection lost. Retrying in {delay}s.")
-                wait_with_progress(delay, f"Reconnecting ({delay}s)")
+                delay = exponential_backoff(attempt, args.delay, args.max_delay, args.jitter)
+                logger.warning("Connection lost. Retrying in %.1fs.", delay)
+                wait_with_progress(delay, f"Reconnecting ({delay:.1f}s)")
                 
                 try:
-                    mail = connect_and_select(server, args.user, args.password, args.folder, args.timeout)
+                    mail = connect_and_select(server, args.user, args.password, args.folder, args.timeout, not args.no_compress)
                     thread_local.mail = mail
                     # Update active connections list safely
                     with connection_lock:
                         if mail not in active_connections:
                             active_connections.append(mail)
                 except Exception as e:
-                    logger.error(f"Reconnection failed: {e}")
+                    logger.error("Reconnection failed: %s", e)
 
             except Exception as e:
                 error_msg = str(e)
-                if "LIMIT" in error_msg.upper():
-                    delay = exponential_backoff(attempt, 15.0) 
+                upper_msg = error_msg.upper()
+                if "BAD" in upper_msg and ("TOO LONG" in upper_msg or "TOO BIG" in upper_msg) \
+                        and current_cmd_bytes > MIN_CMD_BYTES:
+                    new_bytes = max(MIN_CMD_BYTES, current_cmd_bytes // 2)
+                    logger.warning("Command line too long. Reducing command size from %d to %d bytes.", current_cmd_bytes, new_bytes)
+                    current_cmd_bytes = new_bytes
+                    # Split what is left into smaller sets without spending a retry
+                    budget = max(1, current_cmd_bytes - COMMAND_OVERHEAD - len(quoted_trash))
+                    pending = rebatch(chunk_uids, pending, current_chunk_size, budget)
+                    batches = rebatch(chunk_uids, batches, current_chunk_size, budget)
+                    continue
+                elif "LIMIT" in upper_msg:
+                    delay = exponential_backoff(attempt, 15.0, jitter=args.jitter)
                     
                     new_size = max(10, current_chunk_size // 2)
                     if new_size < current_chunk_size:
-                        logger.warning(f"Rate limit hit. Reducing chunk size from {current_chunk_size} to {new_size}.")
+                        logger.warning("Rate limit hit. Reducing chunk size from %d to %d.", current_chunk_size, new_size)
                         current_chunk_size = new_size
                         
-                    logger.warning(f"Pausing for {delay}s before retry.")
-                    wait_with_progress(delay, f"Rate limit ({delay}s)")
+                    logger.warning("Pausing for %.1fs before retry.", delay)
+                    wait_with_progress(delay, f"Rate limit ({delay:.1f}s)")
                     
                     if attempt == args.retries - 1:
-                        logger.error(f"Exhausted retries due to rate limits: {error_msg}")
+                        logger.error("Exhausted retries due to rate limits: %s", error_msg)
                         return processed 
                 else:
                     if attempt == args.retries - 1:
-                        logger.error(f"Failed to process chunk: {error_msg}")
+                        logger.error("Failed to process chunk: %s", error_msg)
                         return processed
-                    wait_with_progress(args.delay, f"Retrying ({args.delay}s)")
+                    delay = exponential_backoff(attempt, args.delay, args.max_delay, args.jitter)
+                    wait_with_progress(delay, f"Retrying ({delay:.1f}s)")
+
+            attempt += 1
+
+        else:
+            # Connection-loss retries ran out without another error path returning
+            logger.error("Failed to process chunk after %d attempts.", args.retries)
+            return processed
 
     return processed
 
 # ---------- Main ----------
 
 def move_to_trash():
+    _configure_logging()
+
     parser = argparse.ArgumentParser(description="Move emails to trash based on sender or time.")
     parser.add_argument("folder", help="Target IMAP folder to scan (e.g., INBOX)")
     parser.add_argument("sender", nargs="?", help="Specific sender email address")
@@ -300,15 +547,22 @@ def move_to_trash():
     parser.add_argument("-t", "--threads", type=int, default=None, help="Number of concurrent threads")
     parser.add_argument("--timeout", type=float, default=30.0)
     parser.add_argument("--delay", type=float, default=2.0)
+    parser.add_argument("--max-delay", type=float, default=30.0, help="Upper bound in seconds for retry backoff")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Random +/- fraction applied to each backoff delay")
     parser.add_argument("--retries", type=int, default=5)
     parser.add_argument("--dry-run", action="store_true")
-    parser.add_argument("--chunk-size", type=int, default=100, help="Number of emails to move per request")
+    parser.add_argument("--no-compress", action="store_true", help="Do not negotiate COMPRESS=DEFLATE even if the server offers it")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Number of emails to move per request")
     parser.add_argument("--chunk-delay", type=float, default=1.0, help="Seconds to wait between chunks to avoid rate limits")
+    parser.add_argument("--max-cmd-bytes", type=int, default=8192, help="Longest UID set to send in one command, in bytes")
+    parser.add_argument("--pipeline", type=int, default=4, help="Chunks sent per connection before waiting for replies")
 
     args = parser.parse_args()
 
     if not args.user or not args.password:
         sys.exit("Error: Username and password must be provided via command-line arguments or environment variables.")
+    args.pipeline = max(1, args.pipeline)
+    args.max_cmd_bytes = max(MIN_CMD_BYTES, args.max_cmd_bytes)
 
     server = args.server.lower()
     is_gmail = "gmail" in server
@@ -324,16 +578,67 @@ def move_to_trash():
         max_workers = 1
 
     # Main connection for initial setup
-    main_mail = connect_and_select(server, args.user, args.password, args.folder, args.timeout)
+    main_mail = connect_and_select(server, args.user, args.password, args.folder, args.timeout, not args.no_compress)
     trash_folder = find_trash_folder(main_mail)
-    supports_move = b"MOVE" in main_mail.capabilities
+    supports_move = "MOVE" in main_mail.capabilities
+    if supports_move:
+        move_mode = "MOVE"
+    elif "X-GM-EXT-1" in main_mail.capabilities:
+        move_mode = "LABEL"
+    else:
+        move_mode = "COPY"
 
     if is_gmail:
         search_query = build_gmail_raw_query(args)
-        uids = run_gmail_search(main_mail, search_query)
+        criteria = ("X-GM-RAW", f'"{search_query}"')
     else:
         search_query = build_standard_search(args)
-        uids = run_standard_search(main_mail, search_query)
+        criteria = (search_query,)
+
+    # A single session can let the server hold the result set instead of shipping UIDs
+    if supports_move and max_workers == 1 and not args.dry_run and "SEARCHRES" in main_mail.capabilities:
+        try:
+            moved = move_saved_search(main_mail, criteria, trash_folder)
+        except (imaplib.IMAP4.error, RuntimeError, OSError) as e:
+            logger.warning("Saved search failed, falling back to UID batches: %s", e)
+            moved = None
+
+            # A timeout or abort leaves the session unusable; the batch path needs a fresh one
+            if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                try:
+                    main_mail.logout()
+                except Exception:
+                    pass
+                try:
+                    main_mail = connect_and_select(server, args.user, args.password, args.folder, args.timeout, not args.no_compress)
+                except Exception as e:
+                    logger.error("Reconnection failed: %s", e)
+                    return
+
+        if moved is not None:
+            if moved:
+                logger.info("Moved %d messages.", moved)
+            else:
+                logger.info("No matching messages.")
+            main_mail.logout()
+            return
+
+    # The cached result is only valid while the mailbox keeps the same UIDVALIDITY
+    _, validity = main_mail.response("UIDVALIDITY")
+    cache_path = None
+    if validity and validity[0] and not args.dry_run:
+        cache_path = search_cache_path(args, server, search_query, validity[0].decode())
+
+    uids = load_cached_uids(cache_path) if cache_path else None
+    if uids is not None:
+        logger.info("Resuming an interrupted run with %d previously matched messages.", len(uids))
+    else:
+        if is_gmail:
+            uids = run_gmail_search(main_mail, search_query)
+        else:
+            uids = run_standard_search(main_mail, search_query)
+        if cache_path and uids:
+            save_cached_uids(cache_path, uids)
 
     total = len(uids)
 
@@ -343,36 +648,50 @@ def move_to_trash():
         return
 
     if args.dry_run:
-        logger.info(f"[DRY RUN] {total} messages would be moved.")
+        logger.info("[DRY RUN] %d messages would be moved.", total)
         main_mail.logout()
         return
 
-    logger.info(f"Processing {total} messages using {max_workers} threads...")
+    logger.info("Processing %d messages using %d threads...", total, max_workers)
     
     # Split total UIDs evenly among threads
     chunk_size = max(1, len(uids) // max_workers)
     chunks = [uids[i:i + chunk_size] for i in range(0, len(uids), chunk_size)]
+    flagged = array("L")
+    moved_total = 0
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = {
-            executor.submit(process_chunk, chunk, trash_folder, supports_move, args, server): chunk 
+            executor.submit(process_chunk, chunk, trash_folder, move_mode, args, server, flagged): chunk 
             for chunk in chunks
         }
         
-        with tqdm(total=total, unit="msg") as pbar:
+        with tqdm(total=total, unit="msg", mininterval=1.0, disable=not sys.stderr.isatty()) as pbar:
             for future in concurrent.futures.as_completed(futures):
                 if shutdown_flag.is_set():
                     break
                 try:
                     processed_count = future.result()
+                    moved_total += processed_count
                     pbar.update(processed_count)
                 except Exception as e:
-                    logger.error(f"Thread execution failed: {e}")
+                    logger.error("Thread execution failed: %s", e)
 
     # Expunge only on the main thread after all workers finish
-    if not supports_move and not shutdown_flag.is_set():
-        logger.info("Expunging deleted messages...")
-        main_mail.expunge()
+    expunged = True
+    if move_mode == "COPY" and not shutdown_flag.is_set():
+        if "UIDPLUS" in main_mail.capabilities:
+            logger.info("Expunging moved messages...")
+            expunged = expunge_flagged(main_mail, sorted(flagged), args)
+        else:
+            logger.info("Expunging deleted messages...")
+            expunged = expunge_all(main_mail)
+
+    if cache_path and moved_total == total and not shutdown_flag.is_set():
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
 
     # Cleanup all connections
     with connection_lock:
@@ -383,7 +702,10 @@ def move_to_trash():
                 pass
                 
     main_mail.logout()
-    logger.info("Completed.")
+    if expunged:
+        logger.info("Completed.")
+    else:
+        logger.warning("Completed, but copied messages are still in %s flagged \\Deleted.", args.folder)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)